@@ -1,3 +1,4 @@
+import os
 import strawberry
 import asyncio
 from fastapi import FastAPI
@@ -6,6 +7,7 @@ from strawberry.fastapi import GraphQLRouter
 from sentiment import SentimentAnalyzer
 
 analyzer = SentimentAnalyzer()
+MAX_BATCH_TEXTS = int(os.environ.get("MAX_BATCH_TEXTS", 256))
 
 @strawberry.type
 class SentimentResult:
@@ -28,6 +30,17 @@ class Query:
         res = await analyzer.predict(text)
         return SentimentResult(label=res["label"], score=res["score"])
 
+    @strawberry.field
+    async def predict_batch(self, texts: list[str]) -> list[SentimentResult]:
+        """Run sentiment prediction on several texts in a single request."""
+        if len(texts) > MAX_BATCH_TEXTS:
+            raise ValueError(f"At most {MAX_BATCH_TEXTS} texts can be sent per request.")
+        if any(not text.strip() for text in texts):
+            raise ValueError("Text inputs cannot be empty.")
+
+        results = await asyncio.gather(*(analyzer.predict(text) for text in texts))
+        return [SentimentResult(label=res["label"], score=res["score"]) for res in results]
+
 schema = strawberry.Schema(query=Query)
 graphql_router = GraphQLRouter(schema, graphql_ide="graphiql")
 
@@ -1,15 +1,14 @@
 # finetune.py
 
 import argparse
-import json
 import os
 import random
+from pathlib import Path
 import numpy as np
 import torch
 from transformers import (
     AutoTokenizer, AutoModelForSequenceClassification,
-    TFAutoModelForSequenceClassification,
-    TrainingArguments, Trainer
+    TrainingArguments, Trainer, DataCollatorWithPadding
 )
 from datasets import Dataset
 from sklearn.metrics import accuracy_score, precision_recall_fscore_support
@@ -18,21 +17,22 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def set_seed(seed=42):
+def set_seed(seed=42, framework='pt'):
     random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
     if torch.cuda.is_available():
         torch.cuda.manual_seed_all(seed)
-    import tensorflow as tf
-    tf.random.set_seed(seed)
+    if framework == 'tf':
+        import tensorflow as tf
+        tf.random.set_seed(seed)
 
 def load_dataset_from_jsonl(file_path):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        data = [json.loads(line) for line in f]
-    texts = [item['text'] for item in data]
-    labels = [1 if item['label'] == 'positive' else 0 for item in data]
-    return Dataset.from_dict({'text': texts, 'label': labels})
+    dataset = Dataset.from_json(file_path)
+    return dataset.map(
+        lambda batch: {'label': [1 if label == 'positive' else 0 for label in batch['label']]},
+        batched=True,
+    )
 
 def compute_metrics(eval_pred):
     predictions, labels = eval_pred
@@ -51,27 +51,45 @@ def main():
     parser.add_argument('--model_name', default='distilbert-base-uncased-finetuned-sst-2-english', help='Pretrained model name from Hugging Face Hub.')
     parser.add_argument('--output_dir', default='./model', help='Directory to save the fine-tuned model.')
     parser.add_argument('--seed', type=int, default=42, help='Random seed for reproducibility.')
+    parser.add_argument('--gradient_accumulation_steps', type=int, default=2, help='Number of batches to accumulate before each optimizer step.')
+    parser.add_argument('--dataloader_num_workers', type=int, default=4, help='Number of worker processes for the training dataloader.')
     args = parser.parse_args()
 
-    set_seed(args.seed)
+    set_seed(args.seed, args.framework)
 
     # Load tokenizer and dataset
     tokenizer = AutoTokenizer.from_pretrained(args.model_name)
     dataset = load_dataset_from_jsonl(args.data)
     
     def tokenize_function(examples):
-        return tokenizer(examples['text'], padding="max_length", truncation=True)
+        return tokenizer(examples['text'], truncation=True, return_length=True)
         
-    tokenized_datasets = dataset.map(tokenize_function, batched=True)
+    tokenized_datasets = dataset.map(
+        tokenize_function,
+        batched=True,
+        batch_size=2000,
+        num_proc=os.cpu_count(),
+        remove_columns=['text'],
+    )
     
     # Split dataset
     train_test_split = tokenized_datasets.train_test_split(test_size=0.1, seed=args.seed)
     train_dataset = train_test_split['train']
     eval_dataset = train_test_split['test']
 
+    # Pad per batch to the longest sequence; multiples of 8 keep tensor-core friendly shapes.
+    data_collator = DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8)
+
     if args.framework == 'pt':
         model = AutoModelForSequenceClassification.from_pretrained(args.model_name, num_labels=2)
-        
+
+        # Mixed precision, TF32, compilation and the fused optimizer only apply on CUDA.
+        use_cuda = torch.cuda.is_available()
+        # BF16 and TF32 are only native on Ampere (compute capability 8.0) and newer.
+        use_ampere = use_cuda and torch.cuda.get_device_capability()[0] >= 8
+        use_bf16 = use_ampere
+        use_tf32 = use_ampere
+
         training_args = TrainingArguments(
             output_dir=args.output_dir,
             num_train_epochs=args.epochs,
@@ -86,6 +104,16 @@ def main():
             weight_decay=0.01,
             max_grad_norm=1.0,
             seed=args.seed,
+            group_by_length=True,
+            length_column_name="length",
+            gradient_accumulation_steps=args.gradient_accumulation_steps,
+            bf16=use_bf16,
+            fp16=use_cuda and not use_bf16,
+            tf32=use_tf32,
+            torch_compile=use_cuda,
+            optim="adamw_torch_fused" if use_cuda else "adamw_torch",
+            dataloader_num_workers=args.dataloader_num_workers,
+            dataloader_pin_memory=use_cuda,
         )
 
         trainer = Trainer(
@@ -95,12 +123,15 @@ def main():
             eval_dataset=eval_dataset,
             compute_metrics=compute_metrics,
             tokenizer=tokenizer,
+            data_collator=data_collator,
         )
         
         logger.info("Starting PyTorch training...")
         trainer.train()
         
     else:
+        from transformers import TFAutoModelForSequenceClassification
+
         model = TFAutoModelForSequenceClassification.from_pretrained(args.model_name, num_labels=2)
         
         training_args = TrainingArguments(
@@ -113,6 +144,8 @@ def main():
              save_strategy="epoch",
              logging_steps=10,
              seed=args.seed,
+             group_by_length=True,
+             length_column_name="length",
         )
 
         trainer = Trainer(
@@ -122,6 +155,7 @@ def main():
             eval_dataset=eval_dataset,
             compute_metrics=compute_metrics,
             tokenizer=tokenizer,
+            data_collator=data_collator,
         )
         
         logger.info("Starting TensorFlow training...")
@@ -130,6 +164,8 @@ def main():
     logger.info(f"Saving model and tokenizer to {args.output_dir}")
     trainer.save_model(args.output_dir)
     tokenizer.save_pretrained(args.output_dir)
+    # Written last so the serving process only reloads once the model is complete.
+    Path(args.output_dir, ".model_ready").touch()
 
     logger.info("Fine-tuning completed successfully!")
 
@@ -1,58 +1,122 @@
 import os
+
+# Thread settings must be in place before torch (and its OpenMP/MKL runtimes) is imported.
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", max(1, (os.cpu_count() or 1) // 2)))
+os.environ.setdefault("OMP_NUM_THREADS", str(TORCH_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(TORCH_THREADS))
+
 import logging
 import asyncio
-import time
-from threading import Lock, Thread
+import copy
+import hashlib
+import numpy as np
+import torch
+from numba import njit
+from contextlib import nullcontext
+from collections import OrderedDict, deque
+from threading import Event, Lock, Thread
 from queue import Queue, Empty
-from transformers import (
-    pipeline,
-    AutoTokenizer,
-    AutoModelForSequenceClassification,
-    TFAutoModelForSequenceClassification
-)
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+torch.set_num_threads(TORCH_THREADS)
+torch.set_num_interop_threads(1)
+
+MODEL_READY_FILE = ".model_ready"
+TOKENIZER_FILES = ("tokenizer.json", "tokenizer_config.json", "vocab.txt", "special_tokens_map.json")
+LABEL_MAP = {
+    "POSITIVE": "positive",
+    "NEGATIVE": "negative",
+    "LABEL_1": "positive",
+    "LABEL_0": "negative",
+}
+
+def _map_label(label):
+    # Anything that is not recognised as positive is treated as negative, as before.
+    return LABEL_MAP.get(label.upper(), "negative")
+
+def _env_flag(name):
+    return os.environ.get(name, "").lower() in ("1", "true", "yes")
+
+@njit(cache=True)
+def pack_batches(lengths, budget, max_bs):
+    """Assigns a batch id to each entry of an ascending array of token lengths."""
+    batch_ids = np.empty(lengths.shape[0], dtype=np.int64)
+    batch_id = 0
+    count = 0
+    for i in range(lengths.shape[0]):
+        # Lengths are sorted, so the incoming item sets the padded length of the batch.
+        padded_tokens = max(lengths[i], 1) * (count + 1)
+        if count > 0 and (count >= max_bs or padded_tokens > budget):
+            batch_id += 1
+            count = 0
+        batch_ids[i] = batch_id
+        count += 1
+    return batch_ids
+
+# Compile at import so the first dispatch does not pay the JIT cost.
+pack_batches(np.ones(1, dtype=np.int64), 1, 1)
+
+def _set_future_result(future, result):
+    # The awaiting request may have been cancelled while the batch was running.
+    if not future.done():
+        future.set_result(result)
+
+def _set_future_exception(future, exc):
+    if not future.done():
+        future.set_exception(exc)
+
 class ModelChangeHandler(FileSystemEventHandler):
     def __init__(self, analyzer_instance):
         self.analyzer = analyzer_instance
-        self.last_reload_time = 0
-        self.reload_cooldown = 2.0
 
     def on_modified(self, event):
-        if not event.is_directory:
-            model_files = ["pytorch_model.bin", "tf_model.h5", "config.json", "tokenizer.json", "tokenizer_config.json"]
-            if any(model_file in event.src_path for model_file in model_files):
-                current_time = time.time()
-                if current_time - self.last_reload_time > self.reload_cooldown:
-                    logger.info(f"Detected modification in model file: {event.src_path}. Triggering model reload.")
-                    self.last_reload_time = current_time
-                    time.sleep(0.5)
-                    self.analyzer.load_model()
+        if not event.is_directory and os.path.basename(event.src_path) == MODEL_READY_FILE:
+            logger.info(f"Detected model ready marker: {event.src_path}. Triggering model reload.")
+            Thread(target=self.analyzer.load_model, daemon=True).start()
 
     def on_created(self, event):
         self.on_modified(event)
 
 class RequestBatcher:
-    def __init__(self, predict_func, batch_size=8, max_latency_ms=50):
+    def __init__(self, predict_func, length_func=None, batch_size=8, max_latency_ms=50, token_budget=4096):
         self.predict_func = predict_func
+        self.length_func = length_func or (lambda text: len(text.split()))
         self.batch_size = batch_size
         self.max_latency = max_latency_ms / 1000.0
+        self.token_budget = token_budget
         self.queue = Queue()
-        self.worker_thread = Thread(target=self._batch_worker, daemon=True)
-        self.worker_thread.start()
+        self.ready_batches = deque()
+        self.batch_ready = Event()
+        self.collector_thread = Thread(target=self._collector_worker, daemon=True)
+        self.runner_thread = Thread(target=self._runner_worker, daemon=True)
+        self.collector_thread.start()
+        self.runner_thread.start()
 
     async def submit(self, text):
         """Submits a request to the batcher and waits for the result."""
-        future = asyncio.Future()
-        self.queue.put((text, future))
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put((self.length_func(text), text, future, loop))
         return await future
 
-    def _batch_worker(self):
-        """The background worker that creates and processes batches."""
+    def _pack_batches(self, items):
+        """Groups items by length into batches that fit the token budget."""
+        items.sort(key=lambda item: item[0])
+        lengths = np.fromiter((item[0] for item in items), dtype=np.int64, count=len(items))
+        batch_ids = pack_batches(lengths, self.token_budget, self.batch_size)
+
+        batches = [[] for _ in range(int(batch_ids[-1]) + 1)]
+        for batch_id, item in zip(batch_ids, items):
+            batches[batch_id].append(item)
+        return batches
+
+    def _collector_worker(self):
+        """Collects queued requests into batches while the runner is busy."""
         while True:
             items = []
             try:
@@ -66,17 +130,38 @@ class RequestBatcher:
                 except Empty:
                     break
 
-            texts = [text for text, future in items]
-            futures = [future for text, future in items]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            self.ready_batches.extend(self._pack_batches(items))
+            self.batch_ready.set()
 
-            try:
-                results = self.predict_func(texts)
-                for future, result in zip(futures, results):
-                    future.set_result(result)
-            except Exception as e:
-                logger.error(f"Error processing batch: {e}", exc_info=True)
-                for future in futures:
-                    future.set_exception(e)
+    def _runner_worker(self):
+        """Runs inference on packed batches as soon as they are available."""
+        while True:
+            self.batch_ready.wait()
+            self.batch_ready.clear()
+            while True:
+                try:
+                    batch = self.ready_batches.popleft()
+                except IndexError:
+                    break
+                self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        texts = [text for _, text, _, _ in batch]
+
+        try:
+            results = self.predict_func(texts)
+            for (_, _, future, loop), result in zip(batch, results):
+                loop.call_soon_threadsafe(_set_future_result, future, result)
+        except Exception as e:
+            logger.error(f"Error processing batch: {e}", exc_info=True)
+            for _, _, future, loop in batch:
+                loop.call_soon_threadsafe(_set_future_exception, future, e)
 
 
 class SentimentAnalyzer:
@@ -84,61 +169,192 @@ class SentimentAnalyzer:
         self.model_name = os.environ.get("MODEL_NAME", "distilbert-base-uncased-finetuned-sst-2-english")
         self.framework = os.environ.get("FRAMEWORK", "pt").lower()
         self.model_path = "./model"
-        self.pipeline = None
+        self.use_onnx = _env_flag("USE_ONNX")
+        self.onnx_quantize = _env_flag("ONNX_QUANTIZE")
+        self.onnx_path = os.environ.get("ONNX_PATH", "./onnx_model")
+        self.torch_compile = _env_flag("TORCH_COMPILE")
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.cpu_bf16 = _env_flag("CPU_BF16")
+        self.runtime = None
+        self.model_version = 0
+        self.tokenizer_key = None
         self.load_lock = Lock()
-        self.batcher = RequestBatcher(self._predict_batch)
+        self.cache = OrderedDict()
+        self.cache_size = int(os.environ.get("CACHE_SIZE", 10000))
+        self.cache_lock = Lock()
+        self.batcher = RequestBatcher(self._predict_batch, length_func=self._text_length)
         self.observer = None
 
         self.load_model()
         self._start_watcher()
 
     def load_model(self):
-        with self.load_lock:
-            try:
-                model_class = AutoModelForSequenceClassification if self.framework == 'pt' else TFAutoModelForSequenceClassification
-                model_file = "pytorch_model.bin" if self.framework == 'pt' else "tf_model.h5"
+        if not self.load_lock.acquire(blocking=False):
+            logger.info("Model reload already in progress, skipping.")
+            return
+        try:
+            if self.framework == 'pt':
+                model_class = AutoModelForSequenceClassification
+            else:
+                from transformers import TFAutoModelForSequenceClassification
+                model_class = TFAutoModelForSequenceClassification
+            # Trainer.save_model writes safetensors by default; older checkpoints use pytorch_model.bin.
+            model_files = ("model.safetensors", "pytorch_model.bin") if self.framework == 'pt' else ("tf_model.h5",)
 
-                if os.path.exists(self.model_path) and os.path.exists(os.path.join(self.model_path, model_file)):
-                    logger.info(f"Loading fine-tuned {self.framework} model from {self.model_path}")
-                    tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+            if any(os.path.exists(os.path.join(self.model_path, model_file)) for model_file in model_files):
+                logger.info(f"Loading fine-tuned {self.framework} model from {self.model_path}")
+                tokenizer, length_tokenizer, tokenizer_key = self._load_tokenizer(self.model_path)
+                if self.framework == 'pt' and self.use_onnx:
+                    model = self._load_onnx_model(self.model_path)
+                else:
                     model = model_class.from_pretrained(self.model_path)
+            else:
+                logger.info(f"Loading pre-trained {self.framework} model: {self.model_name}")
+                tokenizer, length_tokenizer, tokenizer_key = self._load_tokenizer(self.model_name)
+
+                if self.framework == 'pt' and self.use_onnx:
+                    model = self._load_onnx_model(self.model_name)
+                elif self.framework == 'tf' and os.path.exists(os.path.join(self.model_path, "pytorch_model.bin")):
+                    model = model_class.from_pretrained(self.model_name, from_pt=True)
                 else:
-                    logger.info(f"Loading pre-trained {self.framework} model: {self.model_name}")
-                    tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+                    model = model_class.from_pretrained(self.model_name)
+
+            if self.framework == 'pt' and not self.use_onnx:
+                if self.device == "cuda":
+                    # Only use BF16 where it is native; emulated BF16 on pre-Ampere GPUs is slower than FP16.
+                    dtype = torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+                    model = model.to(self.device, dtype=dtype)
+                if self.torch_compile:
+                    self._compile_model(model, tokenizer)
+
+            labels = [_map_label(model.config.id2label[i]) for i in range(model.config.num_labels)]
+            self.runtime = (tokenizer, length_tokenizer, model, labels)
+            self.tokenizer_key = tokenizer_key
+            with self.cache_lock:
+                self.model_version += 1
+                self.cache.clear()
+            logger.info(f"Successfully loaded {self.framework} model.")
+
+        except Exception as e:
+            logger.error(f"Error loading model: {e}", exc_info=True)
+            if self.runtime is None:
+                raise
+        finally:
+            self.load_lock.release()
+
+    def _load_tokenizer(self, source):
+        key = self._tokenizer_key(source)
+        runtime = self.runtime
+        if runtime is not None and key == self.tokenizer_key:
+            logger.info("Tokenizer files unchanged, reusing loaded tokenizer.")
+            return runtime[0], runtime[1], key
+        tokenizer = AutoTokenizer.from_pretrained(source)
+        # The fast tokenizer keeps padding/truncation state that each call may switch, so the
+        # event loop measures lengths with its own copy rather than the one the runner uses.
+        return tokenizer, copy.deepcopy(tokenizer), key
 
-                    if self.framework == 'tf' and os.path.exists(os.path.join(self.model_path, "pytorch_model.bin")):
-                        model = model_class.from_pretrained(self.model_name, from_pt=True)
-                    else:
-                        model = model_class.from_pretrained(self.model_name)
+    def _tokenizer_key(self, source):
+        digest = hashlib.sha256(source.encode())
+        for name in TOKENIZER_FILES:
+            path = os.path.join(source, name)
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    digest.update(name.encode())
+                    digest.update(f.read())
+        return digest.hexdigest()
 
-                if self.pipeline is not None:
-                    del self.pipeline
+    def _load_onnx_model(self, source):
+        from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
 
-                self.pipeline = pipeline("sentiment-analysis", model=model, tokenizer=tokenizer, framework=self.framework)
-                logger.info(f"Successfully loaded {self.framework} model.")
+        logger.info(f"Exporting {source} to ONNX Runtime")
+        model = ORTModelForSequenceClassification.from_pretrained(source, export=True, provider="CPUExecutionProvider")
+        if not self.onnx_quantize:
+            return model
 
-            except Exception as e:
-                logger.error(f"Error loading model: {e}", exc_info=True)
-                if self.pipeline is None:
-                    raise
+        logger.info(f"Quantizing ONNX model to INT8 in {self.onnx_path}")
+        model.save_pretrained(self.onnx_path)
+        quantizer = ORTQuantizer.from_pretrained(model)
+        qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        quantizer.quantize(save_dir=self.onnx_path, quantization_config=qconfig)
+        return ORTModelForSequenceClassification.from_pretrained(
+            self.onnx_path, file_name="model_quantized.onnx", provider="CPUExecutionProvider"
+        )
+
+    def _compile_model(self, model, tokenizer):
+        logger.info("Compiling model with torch.compile")
+        # Batches are padded per request, so compile for dynamic shapes instead of the first one seen.
+        # The default mode is used because reduce-overhead records a new CUDA graph for every shape.
+        model.compile(fullgraph=False, dynamic=True)
+
+        # Trigger compilation now so the first request does not pay for it. Size 1 is always
+        # specialized by torch.compile, so warm single-item batches as well as larger ones.
+        # Inputs go through _encode so a reused serving tokenizer is never switched to other settings.
+        for batch_size, words in ((1, 8), (2, 16), (self.batcher.batch_size, 64)):
+            warmup = self._encode(tokenizer, [" ".join(["warmup"] * words)] * batch_size, "pt").to(model.device)
+            with torch.inference_mode(), self._autocast():
+                model(**warmup)
+
+    def _encode(self, tokenizer, texts, return_tensors):
+        # Every call on the serving tokenizer must use the same padding/truncation settings;
+        # changing them mutates the Rust tokenizer while another thread may be encoding.
+        return tokenizer(texts, padding=True, truncation=True, return_tensors=return_tensors)
+
+    def _autocast(self):
+        # GPU weights are already cast at load time; CPU BF16 only pays off on CPUs with native support.
+        if self.framework == 'pt' and self.device == "cpu" and self.cpu_bf16 and not self.use_onnx:
+            return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+        return nullcontext()
 
     def _predict_batch(self, texts: list[str]):
-        if self.pipeline is None:
+        runtime = self.runtime
+        if runtime is None:
             raise RuntimeError("Model is not loaded.")
-        
-        with self.load_lock:
-            try:
-                results = self.pipeline(texts)
-                return [
-                    {"label": "positive" if res["label"].upper() == "POSITIVE" else "negative", "score": float(res["score"])}
-                    for res in results
-                ]
-            except Exception as e:
-                logger.error(f"Batch prediction error: {e}", exc_info=True)
-                raise
+
+        tokenizer, _, model, labels = runtime
+        try:
+            if self.framework == 'pt':
+                # inference_mode also skips version counters on the input and output tensors.
+                with torch.inference_mode():
+                    inputs = self._encode(tokenizer, texts, "pt").to(model.device)
+                    with self._autocast():
+                        logits = model(**inputs).logits
+                    scores, indices = logits.float().softmax(-1).max(-1)
+                    scores, indices = scores.tolist(), indices.tolist()
+            else:
+                inputs = self._encode(tokenizer, texts, "tf")
+                logits = model(**inputs).logits.numpy()
+                exp = np.exp(logits - logits.max(-1, keepdims=True))
+                probs = exp / exp.sum(-1, keepdims=True)
+                scores, indices = probs.max(-1).tolist(), probs.argmax(-1).tolist()
+            return [{"label": labels[i], "score": score} for i, score in zip(indices, scores)]
+        except Exception as e:
+            logger.error(f"Batch prediction error: {e}", exc_info=True)
+            raise
+
+    def _text_length(self, text: str) -> int:
+        runtime = self.runtime
+        if runtime is None:
+            return len(text.split())
+        return len(runtime[1](text, truncation=True)["input_ids"])
 
     async def predict(self, text: str):
-        return await self.batcher.submit(text)
+        with self.cache_lock:
+            result = self.cache.get(text)
+            if result is not None:
+                self.cache.move_to_end(text)
+                return result
+            version = self.model_version
+
+        result = await self.batcher.submit(text)
+
+        with self.cache_lock:
+            # Skip caching results computed by a model that has since been replaced.
+            if self.cache_size > 0 and version == self.model_version:
+                self.cache[text] = result
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return result
 
     def _start_watcher(self):
         if not os.path.exists(self.model_path):